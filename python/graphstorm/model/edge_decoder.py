@@ -457,7 +457,9 @@ class MLPEFeatEdgeDecoder(MLPEdgeDecoder):
             src_type, _, dest_type = self.target_etype
             ufeat = h[src_type][u]
             ifeat = h[dest_type][v]
-            efeat = e_h[self.target_etype]
+            # Edge features may be stored in half precision, e.g., by WholeGraph.
+            # Convert them to float first, like the node input features.
+            efeat = e_h[self.target_etype].float()
 
             # [src_emb | dest_emb] @ W -> h_dim
             h = th.cat([ufeat, ifeat], dim=1)
@@ -19,10 +19,12 @@
 import os
 
 import json
-import gc
 import logging
+import math
 import re
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import torch as th
 import dgl
 from dataclasses import dataclass
@@ -36,6 +38,8 @@ except ImportError:
     wgth = None
 
 WHOLEGRAPH_INIT = False
+# Name pattern of the partition folders created by distDGL
+_PART_FOLDER_PATTERN = re.compile(r"^part[0-9]+$")
 
 def init_wholegraph():
     """ Initialize Wholegraph"""
@@ -69,15 +73,162 @@ def is_wholegraph_init():
     global WHOLEGRAPH_INIT
     return WHOLEGRAPH_INIT
 
+class _StagingBufferPool:
+    """ A pool of host buffers to stage the rows of WholeGraph partitions.
+
+    The buffers are plain byte tensors, so a released buffer is reused for any
+    partition that fits into it, whatever the shape and dtype of the partition.
+    This lets one pool serve all the features of a conversion. At most
+    ``max_free`` released buffers are kept; the smallest ones are dropped first.
+
+    Parameters
+    ----------
+    max_free : int
+        The maximum number of released buffers kept for reuse. The default covers
+        double buffering: one partition is staged while the previous one is written.
+    """
+    def __init__(self, max_free=2):
+        self._max_free = max_free
+        # Released buffers, sorted by size
+        self._free = []
+
+    def acquire(self, shape, dtype):
+        """ Get a host tensor of the given shape and dtype backed by a pooled buffer.
+        A new buffer is allocated if no free one is large enough.
+
+        Returns
+        -------
+        Tensor : the byte buffer to release once the tensor is not used anymore
+        Tensor : the tensor of the given shape and dtype
+        """
+        nbytes = math.prod(shape) * th.empty((), dtype=dtype).element_size()
+        for i, buf in enumerate(self._free):
+            # Take the smallest buffer that fits
+            if buf.numel() >= nbytes:
+                del self._free[i]
+                break
+        else:
+            buf = th.empty(nbytes, dtype=th.uint8)
+        return buf, buf[:nbytes].view(dtype).view(shape)
+
+    def release(self, buf):
+        """ Return a buffer to the pool so that it can be reused.
+        """
+        self._free.append(buf)
+        self._free.sort(key=lambda b: b.numel())
+        if len(self._free) > self._max_free:
+            # The smallest buffer is the least likely to fit a later partition
+            del self._free[0]
+
+
+def _write_tensors_to_file(tensors, path):
+    """Write the raw bytes of contiguous host tensors to a file, back to back
+
+    The file has the same raw layout as the one written by
+    ``WholeMemoryTensor.local_to_file``, but each tensor is handed to the
+    kernel as one buffer instead of being written in small chunks.
+
+    Parameters
+    ----------
+    tensors : list of Tensor
+        The contiguous host tensors to write
+    path : str
+        Path of the output file
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        for tensor in tensors:
+            data = memoryview(tensor.reshape(-1).view(th.uint8).numpy())
+            # A single write() call is capped at about 2GB on Linux.
+            while data:
+                data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+
+def _make_partition_writer(executor, pool, part_paths, feat_shape, feat_dtype):
+    """Create the functions that write the WholeGraph partitions of one feature
+
+    Everything that is constant for the feature is bound once, so the calls for
+    each partition skip the repeated attribute lookups and path construction.
+    A partition file is written in the background while the next partition is
+    prepared.
+
+    Parameters
+    ----------
+    executor : ThreadPoolExecutor
+        The executor that writes the partition files
+    pool : _StagingBufferPool
+        Pool of the staging buffers
+    part_paths : list of str
+        Paths of the partition files
+    feat_shape : tuple of int
+        The shape of one row of the feature
+    feat_dtype : th.dtype
+        The dtype of the feature in the partition files
+
+    Returns
+    -------
+    callable : ``write(part_num, part_slices)`` writes the rows of a partition
+    callable : ``wait()`` waits for the pending partition write
+    """
+    submit = executor.submit
+    acquire = pool.acquire
+    release = pool.release
+    # The pending write and the staging buffer it reads from
+    writing = None
+
+    def wait():
+        nonlocal writing
+        if writing is not None:
+            future, buf = writing
+            writing = None
+            future.result()
+            if buf is not None:
+                release(buf)
+
+    def write(part_num, part_slices):
+        nonlocal writing
+        if all(t.device.type == "cpu" and t.is_contiguous() and t.dtype == feat_dtype
+               for t in part_slices):
+            # The rows already have the on-disk layout, write them without a copy.
+            # The write task keeps the views, and thus the input memory, alive.
+            buf = None
+            part_data = part_slices
+        else:
+            num_rows = sum(t.shape[0] for t in part_slices)
+            buf, part_tensor = acquire((num_rows, *feat_shape), feat_dtype)
+            # The staging buffers only feed os.write, so they are plain pageable
+            # host memory. The copies below are host-to-host memcpys that also
+            # cast to the stored dtype; pinning either side would only add cost.
+            dst_off = 0
+            for part_slice in part_slices:
+                part_tensor[dst_off:dst_off + part_slice.shape[0]].copy_(part_slice)
+                dst_off += part_slice.shape[0]
+            part_data = [part_tensor]
+        # Wait for the previous partition file before reusing its buffer
+        wait()
+        writing = (submit(_write_tensors_to_file, part_data, part_paths[part_num]), buf)
+
+    return write, wait
+
+
 def wholegraph_processing(
-    whole_feat_tensor, metadata, feat, wg_folder, num_parts
+    feat_tensors, metadata, feat, wg_folder, num_parts, pool=None, target_dtype=None
 ):
     """Convert DGL tensors to wholememory tensor
 
+    The rows of each WholeGraph partition are taken directly from the feature
+    tensors of the input partitions, so the features are never concatenated
+    into one tensor. Contiguous host rows are written to the partition files
+    as they are; other rows are first copied into a staging buffer.
+
     Parameters
     ----------
-    whole_feat_tensor : Tensor
-        The concatenated feature tensor of different partitions
+    feat_tensors : list of Tensor
+        The feature tensors of different partitions, in partition order. The
+        entries are set to None once their rows are written, so that the memory
+        can be released early.
     metadata : Tensor
         Metadata of the feature tensor
     feat : str
@@ -86,44 +237,73 @@ def wholegraph_processing(
         Name of the folder to store the converted files
     num_parts : int
         Number of partitions of the input features
+    pool : _StagingBufferPool, optional
+        Pool of staging buffers shared across features. If None, a pool is
+        created for this feature only.
+    target_dtype : th.dtype, optional
+        The dtype to store floating-point features in, e.g., th.bfloat16. Features
+        of other dtypes, such as integer labels, are stored as they are.
     """
+    num_rows = sum(t.shape[0] for t in feat_tensors)
+    feat_shape = tuple(feat_tensors[0].shape[1:])
+    feat_dtype = feat_tensors[0].dtype
+    if target_dtype is not None and feat_dtype.is_floating_point:
+        feat_dtype = target_dtype
     metadata[feat] = {
-        "shape": list(whole_feat_tensor.shape),
-        "dtype": str(whole_feat_tensor.dtype),
+        "shape": [num_rows, *feat_shape],
+        "dtype": str(feat_dtype),
     }
-    local_comm = wgth.comm.get_local_device_communicator()
     # Round up the integer division to match WholeGraph partitioning scheme
-    subpart_size = -(whole_feat_tensor.shape[0] // -num_parts)
-
-    for part_num in range(num_parts):
-        st = part_num * subpart_size
-        end = (part_num + 1) * subpart_size \
-            if part_num != (num_parts - 1) \
-            else whole_feat_tensor.shape[0]
-
-        wg_tensor = wgth.create_wholememory_tensor(
-            local_comm,
-            "continuous",
-            "cpu",
-            (end - st, *whole_feat_tensor.shape[1:]),
-            whole_feat_tensor.dtype,
-            None,
-        )
-        local_tensor, _ = wg_tensor.get_local_tensor(host_view=True)
-        local_tensor.copy_(whole_feat_tensor[st:end])
-        filename = wgth.utils.get_part_file_name(
-            feat.replace("/", "~"), part_num, num_parts
+    subpart_size = -(num_rows // -num_parts)
+    # Row offsets of all the partitions. Clipping keeps the trailing partitions empty
+    # instead of negative when there are fewer rows than partitions.
+    offsets = np.minimum(np.arange(num_parts + 1, dtype=np.int64) * subpart_size, num_rows)
+    # A partition file is written in the background while the next partition
+    # is copied, so at most two staging buffers are in use.
+    if pool is None:
+        pool = _StagingBufferPool()
+    # Output file paths of all the partitions of the feature
+    feat_prefix = feat.replace("/", "~")
+    part_paths = [
+        os.path.join(wg_folder, wgth.utils.get_part_file_name(feat_prefix, part, num_parts))
+        for part in range(num_parts)
+    ]
+    # The input tensor and the row inside it that the next copy starts from.
+    src_idx, src_off = 0, 0
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        write, wait = _make_partition_writer(
+            executor, pool, part_paths, feat_shape, feat_dtype
         )
-        wg_tensor.local_to_file(os.path.join(wg_folder, filename))
-        wgth.destroy_wholememory_tensor(wg_tensor)
+        for part_num, num_left in enumerate(np.diff(offsets).tolist()):
+            # Views of the input rows that make up this partition
+            part_slices = []
+            while num_left > 0:
+                src = feat_tensors[src_idx]
+                num = min(num_left, src.shape[0] - src_off)
+                part_slices.append(src[src_off:src_off + num])
+                num_left -= num
+                src_off += num
+                if src_off == src.shape[0]:
+                    feat_tensors[src_idx] = None
+                    src_idx, src_off = src_idx + 1, 0
+            write(part_num, part_slices)
+        # Release the trailing inputs without rows, the walk above never reaches them
+        feat_tensors[src_idx:] = [None] * (len(feat_tensors) - src_idx)
+        wait()
 
 
 def trim_feat_files(trimmed_feats, folder, file_name, part):
     """Save new truncated distDGL tensors
+
+    The tensors are saved next to the original feature file as ``new_<file_name>``.
+    The original file is only replaced by ``replace_feat_files``, so that it can be
+    done after all the features are converted.
+
     Parameters
     ----------
-    trimmed_feats : list of tensors
-        distDGL tensors after trimming out the processed features
+    trimmed_feats : dict of tensors
+        distDGL tensors of the partition after trimming out the processed features
     folder : str
         Name of the folder of the input feature files
     file_name : str
@@ -133,8 +313,24 @@ def trim_feat_files(trimmed_feats, folder, file_name, part):
 
     """
     dgl.data.utils.save_tensors(
-        os.path.join(folder, f"part{part}", "new_" + file_name), trimmed_feats[part]
+        os.path.join(folder, f"part{part}", "new_" + file_name), trimmed_feats
     )
+
+
+def replace_feat_files(folder, file_name, part):
+    """Replace the original distDGL tensors with the truncated ones
+
+    The original feature file is kept as a ``.bak`` file.
+
+    Parameters
+    ----------
+    folder : str
+        Name of the folder of the input feature files
+    file_name : str
+        Name of the feature file, either node_feat.dgl or edge_feat.dgl
+    part : int
+        Partition number of the input feature files
+    """
     os.rename(
         os.path.join(folder, f"part{part}", file_name),
         os.path.join(folder, f"part{part}", file_name + ".bak"),
@@ -145,7 +341,51 @@ def trim_feat_files(trimmed_feats, folder, file_name, part):
     )
 
 
-def convert_feat_to_wholegraph(fname_dict, file_name, metadata, folder, use_low_mem):
+def _check_feat_names(feats, feat_names):
+    """Check that the loaded distDGL tensors contain the given features
+
+    Parameters
+    ----------
+    feats : dict of Tensor
+        distDGL tensors of a partition
+    feat_names : list of str
+        Names of the features to check
+    """
+    for feat in feat_names:
+        if feat not in feats:
+            raise RuntimeError(
+                f"Error: Unknown feature '{feat}'. Files contain \
+                           the following features: {feats.keys()}."
+            )
+
+
+def _load_feat_tensors(path, feat_names):
+    """Load the given features from a distDGL tensor file
+
+    distDGL tensor files are serialized by DGL and can only be loaded as a whole,
+    so the requested features are returned separately from the other ones. Callers
+    that do not need the other features can drop them right after loading to release
+    their memory.
+
+    Parameters
+    ----------
+    path : str
+        Path of the feature file
+    feat_names : list of str
+        Names of the features to keep
+
+    Returns
+    -------
+    dict of Tensor : the requested features
+    dict of Tensor : the other features in the file
+    """
+    feats = dgl.data.utils.load_tensors(path)
+    _check_feat_names(feats, feat_names)
+    return {feat: feats.pop(feat) for feat in feat_names}, feats
+
+
+def convert_feat_to_wholegraph(fname_dict, file_name, metadata, folder, use_low_mem,
+                               target_dtype=None):
     """Convert features from distDGL tensor format to WholeGraph format
 
     Parameters
@@ -160,90 +400,95 @@ def convert_feat_to_wholegraph(fname_dict, file_name, metadata, folder, use_low_
         Name of the folder of the input feature files
     use_low_mem: bool
         Whether to use low memory version for conversion
+    target_dtype: th.dtype
+        The dtype to store floating-point features in. If None, features keep their
+        original dtype.
     """
     wg_folder = os.path.join(folder, "wholegraph")
-    folder_pattern = re.compile(r"^part[0-9]+$")
-    part_files = [
-        f
-        for f in os.listdir(folder)
-        if os.path.isdir(os.path.join(folder, f)) and folder_pattern.match(f)
+    # os.scandir gets the entry types from the directory listing itself,
+    # so there is no stat call per entry.
+    with os.scandir(folder) as entries:
+        part_files = sorted(
+            (e.name for e in entries
+             if _PART_FOLDER_PATTERN.match(e.name) and e.is_dir()),
+            key=lambda x: int(x[len("part"):]),
+        )
+    # Fully-qualified feature names as stored in the distDGL tensor files
+    feat_names = [
+        f"{type_name}/{feat}" for type_name, feats in fname_dict.items() for feat in feats
     ]
-    part_files = sorted(part_files, key=lambda x: int(x.split("part")[1]))
+    # Paths of the distDGL tensor files of all the partitions
+    part_paths = [os.path.join(folder, name, file_name) for name in part_files]
     feats_data = []
+    # Staging buffers are reused across partitions and features
+    pool = _StagingBufferPool()
 
     # When 'use_low_mem' is not enabled, this code loads and appends features from individual
-    # partitions. Then features are concatenated and converted into the WholeGraph format one
-    # by one. The minimum memory requirement for this approach is 2X the size of the input
-    # nodes or edges features in the graph.
+    # partitions. Then features are converted into the WholeGraph format one by one, copying
+    # the rows of each WholeGraph partition directly from the loaded partitions. The minimum
+    # memory requirement for this approach is the size of the input nodes or edges features
+    # in the graph plus the size of two WholeGraph partitions.
     if not use_low_mem:
-        # Read features from file
-        for path in (os.path.join(folder, name) for name in part_files):
-            feats_data.append(dgl.data.utils.load_tensors(f"{path}/{file_name}"))
+        # Read features from file. The partition files are independent, so
+        # read them concurrently.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            feats_data = list(executor.map(dgl.data.utils.load_tensors, part_paths))
         num_parts = len(feats_data)
-        for type_name, feats in fname_dict.items():
-            for feat in feats:
-                feat = type_name + "/" + feat
-                if feat not in feats_data[0]:
-                    raise RuntimeError(
-                        f"Error: Unknown feature '{feat}'. Files contain \
-                                       the following features: {feats_data[0].keys()}."
-                    )
-                logging.info("Processing %s features...", feat)
-                whole_feat_tensor = th.concat(
-                    tuple(t[feat] for t in feats_data), dim=0
-                )
-                # Delete processed feature from memory
-                for t in feats_data:
-                    del t[feat]
-                wholegraph_processing(
-                    whole_feat_tensor, metadata, feat, wg_folder, num_parts
-                )
+        for feats in feats_data:
+            _check_feat_names(feats, feat_names)
+        for feat in feat_names:
+            logging.info("Processing %s features...", feat)
+            # Delete processed feature from memory once it is converted
+            feat_tensors = [t.pop(feat) for t in feats_data]
+            wholegraph_processing(
+                feat_tensors, metadata, feat, wg_folder, num_parts, pool,
+                target_dtype=target_dtype,
+            )
         # Trim the original distDGL tensors
         for part in range(num_parts):
-            trim_feat_files(feats_data, folder, file_name, part)
+            trim_feat_files(feats_data[part], folder, file_name, part)
+        for part in range(num_parts):
+            replace_feat_files(folder, file_name, part)
 
     # This low-memory version loads one partition at a time. It processes features one by one,
     # iterating through all the partitions and appending only the current feature, converting
-    # it to a WholeGraph. The minimum memory requirement for this approach is 2X the size of
-    # the largest node or edge feature in the graph.
+    # it to a WholeGraph. The minimum memory requirement for this approach is the size of the
+    # largest node or edge feature in the graph plus the size of one partition file. The
+    # trimmed distDGL tensors are saved while processing the last feature, so that the
+    # partition files are not loaded once more just for trimming. The original files are
+    # only replaced after all the features are converted, so a failure leaves them intact.
     else:  # low-mem
-        for ntype, feats in fname_dict.items():
-            for feat in feats:
-                feat = ntype + "/" + feat
-                node_feats_data = None
-                num_parts = 0
-                # Read features from file
-                for path in (os.path.join(folder, name) for name in part_files):
-                    nfeat = dgl.data.utils.load_tensors(f"{path}/{file_name}")
-                    if feat not in nfeat:
-                        raise RuntimeError(
-                            f"Error: Unknown feature '{feat}'. Files contain \
-                                       the following features: {nfeat.keys()}."
-                        )
-                    if node_feats_data is None:
-                        node_feats_data = nfeat[feat]
-                    else:
-                        node_feats_data = th.concat((node_feats_data, nfeat[feat]), dim=0)
-                    num_parts += 1
-                del nfeat
-                gc.collect()
-                wholegraph_processing(
-                    node_feats_data,
-                    metadata,
-                    feat,
-                    wg_folder,
-                    num_parts,
-                )
-        num_parts = 0
-        for path in (os.path.join(folder, name) for name in part_files):
-            feats_data = dgl.data.utils.load_tensors(f"{path}/{file_name}")
-            for type_name, feats in fname_dict.items():
-                for feat in feats:
-                    feat = type_name + "/" + feat
-                    # Delete processed feature from memory
-                    del feats_data[feat]
-            num_parts += 1
-            trim_feat_files(feats_data, folder, file_name, num_parts)
+        for i, feat in enumerate(feat_names):
+            is_last_feat = i == len(feat_names) - 1
+            # Per-partition tensors of the feature, WholeGraph partitions are
+            # copied from them directly instead of concatenating them.
+            node_feats_data = []
+            # Read features from file
+            for part, path in enumerate(part_paths):
+                if is_last_feat:
+                    nfeat, trimmed_feats = _load_feat_tensors(path, feat_names)
+                    # Save the trimmed distDGL tensors
+                    trim_feat_files(trimmed_feats, folder, file_name, part)
+                    del trimmed_feats
+                else:
+                    nfeat = _load_feat_tensors(path, [feat])[0]
+                node_feats_data.append(nfeat[feat])
+            # The loaded dicts hold no reference cycles, so dropping the last one frees
+            # it by reference counting; no full garbage collection is needed. This also
+            # lets wholegraph_processing release the last partition early.
+            del nfeat
+            wholegraph_processing(
+                node_feats_data,
+                metadata,
+                feat,
+                wg_folder,
+                len(node_feats_data),
+                pool,
+                target_dtype=target_dtype,
+            )
+        if feat_names:
+            for part in range(len(part_paths)):
+                replace_feat_files(folder, file_name, part)
 
 
 def load_wg_feat(part_config_path, num_parts, type_name, name):
@@ -517,11 +762,10 @@ class WholeGraphDistTensor:
             The requested node embeddings.
         """
         assert self._tensor is not None, "Please create WholeGraph tensor first."
-        idx = idx.cuda()
-        val = val.cuda()
-
-        if val.dtype != self.dtype:
-            val = val.to(self.dtype)
+        idx = idx.to(device="cuda", non_blocking=True)
+        # Cast and transfer in one call, so a host tensor is converted before the copy
+        # and only the bytes of the target dtype are moved to GPU.
+        val = val.to(device="cuda", dtype=self.dtype, non_blocking=True)
         self._tensor.get_embedding_tensor().scatter(val, idx)
 
     def __getitem__(self, idx: th.Tensor) -> th.Tensor:
@@ -539,7 +783,8 @@ class WholeGraphDistTensor:
             The requested node embeddings.
         """
         assert self._tensor is not None, "Please create WholeGraph tensor first."
-        idx = idx.cuda()
+        # No-op when the index is already on GPU, e.g., produced by a GPU sampler.
+        idx = idx.to(device="cuda", non_blocking=True)
         output_tensor = self._tensor.gather(idx)  # output_tensor is on cuda by default
         return output_tensor
 
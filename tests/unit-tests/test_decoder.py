@@ -480,6 +480,32 @@ def test_MLPEFeatEdgeDecoder(h_dim, feat_dim, out_dim, num_ffn_layers):
         pred = out.argmax(dim=1)
         assert_almost_equal(prediction.cpu().numpy(), pred.cpu().numpy())
 
+@pytest.mark.parametrize("efeat_dtype", [th.float16, th.bfloat16])
+def test_MLPEFeatEdgeDecoder_half_efeat(efeat_dtype):
+    """ Edge features stored in half precision are decoded like float ones """
+    g = generate_dummy_hetero_graph()
+    target_etype = ("n0", "r0", "n1")
+    h_dim, feat_dim = 16, 8
+    encoder_feat = {
+        "n0": th.randn(g.num_nodes("n0"), h_dim),
+        "n1": th.randn(g.num_nodes("n1"), h_dim)
+    }
+    efeat = th.randn(g.num_edges(target_etype), feat_dim).to(efeat_dtype)
+    decoder = MLPEFeatEdgeDecoder(h_dim,
+                                  feat_dim,
+                                  2,
+                                  multilabel=False,
+                                  target_etype=target_etype)
+    with th.no_grad():
+        decoder.eval()
+        output = decoder(g, encoder_feat, {target_etype: efeat})
+        out = decoder(g, encoder_feat, {target_etype: efeat.float()})
+        assert output.dtype == th.float32
+        assert_almost_equal(output.cpu().numpy(), out.cpu().numpy())
+
+        prediction = decoder.predict(g, encoder_feat, {target_etype: efeat})
+        assert_almost_equal(prediction.cpu().numpy(), out.argmax(dim=1).cpu().numpy())
+
 if __name__ == '__main__':
     test_LinkPredictContrastiveDistMultDecoder(32, 8, 16, "cpu")
     test_LinkPredictContrastiveDistMultDecoder(16, 32, 32, "cuda:0")
@@ -493,3 +519,4 @@ if __name__ == '__main__':
 
     test_MLPEFeatEdgeDecoder(16,8,2)
     test_MLPEFeatEdgeDecoder(16,32,2)
+    test_MLPEFeatEdgeDecoder_half_efeat(th.bfloat16)
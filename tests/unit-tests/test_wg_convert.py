@@ -0,0 +1,352 @@
+"""
+    Copyright 2023 Contributors
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Unit tests for converting distDGL features to the WholeGraph format
+"""
+import os
+import json
+import tempfile
+
+import numpy as np
+import pytest
+import torch as th
+from dgl.data.utils import load_tensors, save_tensors
+from numpy.testing import assert_equal
+
+from graphstorm.wholegraph import init_wholegraph, is_wholegraph_init, load_wg_feat
+from graphstorm.wholegraph.wholegraph import (
+    _load_feat_tensors,
+    _write_tensors_to_file,
+    convert_feat_to_wholegraph,
+    replace_feat_files,
+    trim_feat_files,
+    wholegraph_processing,
+)
+
+
+def _standalone_initialize():
+    from dgl.distributed import role
+    role.init_role("default")
+    os.environ["DGL_DIST_MODE"] = "standalone"
+
+    backend = "nccl"
+    assert th.cuda.is_available(), "NCCL backend requires CUDA device(s) to be available."
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = "29501"
+    os.environ["RANK"] = "0"
+    os.environ["WORLD_SIZE"] = "1"
+    os.environ["LOCAL_RANK"] = "0"
+    os.environ["LOCAL_WORLD_SIZE"] = "1"
+    th.cuda.set_device(int(os.environ['LOCAL_RANK']))
+    th.distributed.init_process_group(backend=backend, rank=0, world_size=1)
+    init_wholegraph()
+
+def _finalize():
+    if is_wholegraph_init():
+        import pylibwholegraph.torch as wgth
+        wgth.finalize()
+        # below patch fix (manually reset wg comm) will not be needed
+        # once PR: https://github.com/rapidsai/wholegraph/pull/111 is merged.
+        import pylibwholegraph.torch.comm as wgth_comm
+        wgth_comm.global_communicators = {}
+        wgth_comm.local_node_communicator = None
+        wgth_comm.local_device_communicator = None
+    th.distributed.destroy_process_group() if th.distributed.is_initialized() else None
+
+def _read_wg_parts(wg_folder, feat, num_parts, dtype, feat_shape):
+    """ Read the raw WholeGraph partition files of a feature back into tensors """
+    import pylibwholegraph.torch as wgth
+    parts = []
+    for part in range(num_parts):
+        path = os.path.join(
+            wg_folder, wgth.utils.get_part_file_name(feat.replace("/", "~"), part, num_parts))
+        data = th.from_numpy(np.fromfile(path, dtype=np.uint8))
+        parts.append(data.view(dtype).reshape(-1, *feat_shape))
+    return parts
+
+def _expected_part_sizes(num_rows, num_parts):
+    """ Partition sizes of the WholeGraph partitioning scheme """
+    subpart_size = -(num_rows // -num_parts)
+    return [max(0, min(subpart_size, num_rows - part * subpart_size))
+            for part in range(num_parts)]
+
+@pytest.mark.parametrize("src_sizes,num_parts", [
+    ([3, 5, 2], 4),     # partitions straddle the input boundaries
+    ([7], 3),           # a single input split into several partitions
+    ([2, 2, 2, 2], 2),  # several inputs make up one partition
+    ([0, 4, 0, 3], 2),  # empty inputs
+    ([1, 2], 5),        # fewer rows than partitions
+    ([0, 0], 2),        # no rows at all
+])
+@pytest.mark.parametrize("feat_shape", [(), (4,), (2, 3)])
+def test_wholegraph_processing(src_sizes, num_parts, feat_shape):
+    pytest.importorskip("pylibwholegraph.torch")
+    feat = "n0/feat"
+    feat_tensors = [th.randn(size, *feat_shape) for size in src_sizes]
+    expected = th.cat(feat_tensors)
+    input_tensors = list(feat_tensors)
+    metadata = {}
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        wholegraph_processing(input_tensors, metadata, feat, tmpdirname, num_parts)
+        parts = _read_wg_parts(tmpdirname, feat, num_parts, th.float32, feat_shape)
+
+    # The inputs are released once they are written
+    assert all(t is None for t in input_tensors)
+    assert metadata[feat]["shape"] == [sum(src_sizes), *feat_shape]
+    assert metadata[feat]["dtype"] == "torch.float32"
+    assert [part.shape[0] for part in parts] == _expected_part_sizes(sum(src_sizes), num_parts)
+    assert_equal(th.cat(parts).numpy(), expected.numpy())
+
+def test_wholegraph_processing_staging():
+    """ Inputs that cannot be written as they are get staged into a host buffer """
+    pytest.importorskip("pylibwholegraph.torch")
+    feat = "n0,r0,n1/feat"
+    # A transposed input is not contiguous
+    feat_tensors = [th.randn(4, 5).t(), th.randn(3, 4), th.randn(2, 4).double()]
+    expected = th.cat([t.float() for t in feat_tensors])
+    input_tensors = list(feat_tensors)
+    metadata = {}
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        wholegraph_processing(input_tensors, metadata, feat, tmpdirname, 3)
+        parts = _read_wg_parts(tmpdirname, feat, 3, th.float32, (4,))
+
+    assert all(t is None for t in input_tensors)
+    assert metadata[feat]["shape"] == [10, 4]
+    assert [part.shape[0] for part in parts] == [4, 4, 2]
+    assert_equal(th.cat(parts).numpy(), expected.numpy())
+
+@pytest.mark.parametrize("target_dtype", [th.float16, th.bfloat16])
+def test_wholegraph_processing_target_dtype(target_dtype):
+    pytest.importorskip("pylibwholegraph.torch")
+    float_tensors = [th.randn(3, 4), th.randn(2, 4)]
+    int_tensors = [th.arange(3), th.arange(3, 5)]
+    expected_float = th.cat(float_tensors).to(target_dtype)
+    expected_int = th.cat(int_tensors)
+    metadata = {}
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        wholegraph_processing(list(float_tensors), metadata, "n0/feat", tmpdirname, 2,
+                              target_dtype=target_dtype)
+        wholegraph_processing(list(int_tensors), metadata, "n0/label", tmpdirname, 2,
+                              target_dtype=target_dtype)
+        float_parts = _read_wg_parts(tmpdirname, "n0/feat", 2, target_dtype, (4,))
+        int_parts = _read_wg_parts(tmpdirname, "n0/label", 2, th.int64, ())
+
+    # Floating-point features are stored in the target dtype
+    assert metadata["n0/feat"] == {"shape": [5, 4], "dtype": str(target_dtype)}
+    assert_equal(th.cat(float_parts).float().numpy(), expected_float.float().numpy())
+    # Integer features are stored as they are
+    assert metadata["n0/label"] == {"shape": [5], "dtype": "torch.int64"}
+    assert_equal(th.cat(int_parts).numpy(), expected_int.numpy())
+
+def test_load_feat_tensors():
+    feats = {
+        "n0/feat": th.randn(5, 4),
+        "n0/label": th.arange(5),
+        "n1/feat": th.randn(3, 2),
+    }
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, "node_feat.dgl")
+        save_tensors(path, feats)
+
+        loaded, others = _load_feat_tensors(path, ["n0/feat", "n1/feat"])
+        assert set(loaded.keys()) == {"n0/feat", "n1/feat"}
+        assert set(others.keys()) == {"n0/label"}
+        assert_equal(loaded["n0/feat"].numpy(), feats["n0/feat"].numpy())
+        assert_equal(loaded["n1/feat"].numpy(), feats["n1/feat"].numpy())
+        assert_equal(others["n0/label"].numpy(), feats["n0/label"].numpy())
+
+        loaded, others = _load_feat_tensors(path, [])
+        assert len(loaded) == 0
+        assert set(others.keys()) == set(feats.keys())
+
+        with pytest.raises(RuntimeError, match="Unknown feature 'n0/feat2'"):
+            _load_feat_tensors(path, ["n0/feat", "n0/feat2"])
+
+def test_trim_and_replace_feat_files():
+    feats = {"n0/feat": th.randn(5, 4), "n0/label": th.arange(5)}
+    trimmed = {"n0/label": feats["n0/label"]}
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        part_folder = os.path.join(tmpdirname, "part1")
+        os.mkdir(part_folder)
+        path = os.path.join(part_folder, "node_feat.dgl")
+        save_tensors(path, feats)
+
+        trim_feat_files(trimmed, tmpdirname, "node_feat.dgl", 1)
+        # The original file is left untouched until it is replaced
+        assert set(load_tensors(path).keys()) == set(feats.keys())
+        new_feats = load_tensors(os.path.join(part_folder, "new_node_feat.dgl"))
+        assert set(new_feats.keys()) == {"n0/label"}
+        assert not os.path.exists(path + ".bak")
+
+        replace_feat_files(tmpdirname, "node_feat.dgl", 1)
+        assert not os.path.exists(os.path.join(part_folder, "new_node_feat.dgl"))
+        backup = load_tensors(path + ".bak")
+        assert set(backup.keys()) == set(feats.keys())
+        assert_equal(backup["n0/feat"].numpy(), feats["n0/feat"].numpy())
+        new_feats = load_tensors(path)
+        assert set(new_feats.keys()) == {"n0/label"}
+        assert_equal(new_feats["n0/label"].numpy(), feats["n0/label"].numpy())
+
+@pytest.mark.parametrize("use_low_mem", [False, True])
+def test_convert_feat_to_wholegraph(use_low_mem):
+    pytest.importorskip("pylibwholegraph.torch")
+    part_sizes = [4, 3, 5]
+    part_feats = [{
+        "n0/feat": th.randn(size, 4),
+        "n0/feat1": th.randn(size),
+        "n0/label": th.arange(size),
+    } for size in part_sizes]
+    metadata = {}
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        for part, feats in enumerate(part_feats):
+            os.mkdir(os.path.join(tmpdirname, f"part{part}"))
+            save_tensors(os.path.join(tmpdirname, f"part{part}", "node_feat.dgl"), feats)
+        wg_folder = os.path.join(tmpdirname, "wholegraph")
+        os.mkdir(wg_folder)
+
+        convert_feat_to_wholegraph({"n0": ["feat", "feat1"]}, "node_feat.dgl",
+                                   metadata, tmpdirname, use_low_mem)
+
+        for feat, feat_shape in [("n0/feat", (4,)), ("n0/feat1", ())]:
+            assert metadata[feat]["shape"] == [sum(part_sizes), *feat_shape]
+            parts = _read_wg_parts(wg_folder, feat, len(part_sizes), th.float32, feat_shape)
+            expected = th.cat([feats[feat] for feats in part_feats])
+            assert_equal(th.cat(parts).numpy(), expected.numpy())
+        for part, feats in enumerate(part_feats):
+            path = os.path.join(tmpdirname, f"part{part}", "node_feat.dgl")
+            assert not os.path.exists(os.path.join(tmpdirname, f"part{part}",
+                                                   "new_node_feat.dgl"))
+            assert set(load_tensors(path + ".bak").keys()) == set(feats.keys())
+            trimmed = load_tensors(path)
+            assert set(trimmed.keys()) == {"n0/label"}
+            assert_equal(trimmed["n0/label"].numpy(), feats["n0/label"].numpy())
+
+def test_convert_feat_to_wholegraph_unknown_feat():
+    """ The feature files are left intact when a feature is missing """
+    pytest.importorskip("pylibwholegraph.torch")
+    part_feats = [{"n0/feat": th.randn(3, 4)}, {"n0/feat": th.randn(2, 4)}]
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        for part, feats in enumerate(part_feats):
+            os.mkdir(os.path.join(tmpdirname, f"part{part}"))
+            save_tensors(os.path.join(tmpdirname, f"part{part}", "node_feat.dgl"), feats)
+        os.mkdir(os.path.join(tmpdirname, "wholegraph"))
+
+        for use_low_mem in [False, True]:
+            with pytest.raises(RuntimeError, match="Unknown feature"):
+                convert_feat_to_wholegraph({"n0": ["feat", "feat2"]}, "node_feat.dgl",
+                                           {}, tmpdirname, use_low_mem)
+            for part in range(len(part_feats)):
+                files = os.listdir(os.path.join(tmpdirname, f"part{part}"))
+                assert files == ["node_feat.dgl"]
+
+@pytest.mark.parametrize("dtype", [th.float32, th.bfloat16])
+@pytest.mark.parametrize("feat_shape", [(), (4,)])
+@pytest.mark.parametrize("num_rows,num_parts", [(10, 3), (2, 4)])
+def test_wg_feat_file_roundtrip(dtype, feat_shape, num_rows, num_parts):
+    """ Files written for WholeGraph match the layout WholeGraph reads and writes itself
+
+        The conversion writes the raw bytes of the tensors. They must be identical
+        to the file written by WholeMemoryTensor.local_to_file, and load_wg_feat
+        must read them back.
+    """
+    pytest.importorskip("pylibwholegraph.torch")
+    if th.cuda.device_count() == 0:
+        pytest.skip("Skip test_wg_feat_file_roundtrip due to no GPU devices.")
+    import pylibwholegraph.torch as wgth
+    _standalone_initialize()
+    feat = th.randn(num_rows, *feat_shape).to(dtype)
+    # WholeGraph stores a 1-D feature as a 2-D tensor with one column
+    wm_shape = [num_rows, 1] if len(feat_shape) == 0 else [num_rows, *feat_shape]
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        comm = wgth.comm.get_global_communicator()
+        wm_tensor = wgth.create_wholememory_tensor(comm, "distributed", "cpu",
+                                                   wm_shape, dtype, None)
+        wm_tensor.scatter(feat.reshape(wm_shape).cuda(), th.arange(num_rows).cuda())
+        wm_path = os.path.join(tmpdirname, "wm_feat.bin")
+        wm_tensor.local_to_file(wm_path)
+        gs_path = os.path.join(tmpdirname, "gs_feat.bin")
+        # Write the rows in several pieces, like the rows of a WholeGraph partition
+        _write_tensors_to_file(list(th.split(feat, 3)), gs_path)
+        with open(wm_path, "rb") as wm_file, open(gs_path, "rb") as gs_file:
+            assert wm_file.read() == gs_file.read()
+
+        wg_folder = os.path.join(tmpdirname, "wholegraph")
+        os.mkdir(wg_folder)
+        metadata = {}
+        wholegraph_processing(list(th.split(feat, 4)), metadata, "n0/feat",
+                              wg_folder, num_parts)
+        if num_rows < num_parts:
+            # Trailing partitions without rows are written as empty files
+            assert os.path.getsize(os.path.join(
+                wg_folder, wgth.utils.get_part_file_name("n0~feat", num_parts - 1,
+                                                         num_parts))) == 0
+        with open(os.path.join(wg_folder, "metadata.json"), "w", encoding="utf8") as f:
+            json.dump(metadata, f)
+        part_config = os.path.join(tmpdirname, "graph.json")
+        wm_embedding = load_wg_feat(part_config, num_parts, "n0", "feat")
+        loaded = wm_embedding.get_embedding_tensor().gather(th.arange(num_rows).cuda())
+        assert loaded.dtype == dtype
+        assert_equal(loaded.cpu().float().numpy(),
+                     feat.reshape(wm_shape).float().numpy())
+    _finalize()
+
+@pytest.mark.parametrize("target_dtype", [None, th.float16, th.bfloat16])
+def test_load_wg_feat_target_dtype(target_dtype):
+    """ load_wg_feat creates the WholeGraph embedding with the dtype in the metadata """
+    pytest.importorskip("pylibwholegraph.torch")
+    if th.cuda.device_count() == 0:
+        pytest.skip("Skip test_load_wg_feat_target_dtype due to no GPU devices.")
+    _standalone_initialize()
+    feats = {"feat": th.randn(7, 4), "label": th.arange(7)}
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        wg_folder = os.path.join(tmpdirname, "wholegraph")
+        os.mkdir(wg_folder)
+        metadata = {}
+        for name, feat in feats.items():
+            wholegraph_processing(list(th.split(feat, 3)), metadata, "n0/" + name,
+                                  wg_folder, 2, target_dtype=target_dtype)
+        with open(os.path.join(wg_folder, "metadata.json"), "w", encoding="utf8") as f:
+            json.dump(metadata, f)
+        part_config = os.path.join(tmpdirname, "graph.json")
+
+        wm_embedding = load_wg_feat(part_config, 2, "n0", "feat")
+        loaded = wm_embedding.get_embedding_tensor().gather(th.arange(7).cuda())
+        expected_dtype = th.float32 if target_dtype is None else target_dtype
+        assert loaded.dtype == expected_dtype
+        assert_equal(loaded.cpu().float().numpy(),
+                     feats["feat"].to(expected_dtype).float().numpy())
+
+        wm_embedding = load_wg_feat(part_config, 2, "n0", "label")
+        loaded = wm_embedding.get_embedding_tensor().gather(th.arange(7).cuda())
+        assert loaded.dtype == th.int64
+        assert_equal(loaded.cpu().reshape(-1).numpy(), feats["label"].numpy())
+    _finalize()
+
+
+if __name__ == '__main__':
+    test_wholegraph_processing([3, 5, 2], 4, (4,))
+    test_wholegraph_processing([0, 4, 0, 3], 2, ())
+    test_wholegraph_processing([1, 2], 5, (4,))
+    test_wholegraph_processing_staging()
+    test_wholegraph_processing_target_dtype(th.float16)
+    test_wholegraph_processing_target_dtype(th.bfloat16)
+    test_load_feat_tensors()
+    test_trim_and_replace_feat_files()
+    test_convert_feat_to_wholegraph(False)
+    test_convert_feat_to_wholegraph(True)
+    test_convert_feat_to_wholegraph_unknown_feat()
+    test_wg_feat_file_roundtrip(th.float32, (4,), 10, 3)
+    test_wg_feat_file_roundtrip(th.bfloat16, (), 10, 3)
+    test_load_wg_feat_target_dtype(th.bfloat16)
@@ -91,7 +91,7 @@ def get_edge_feat_info(edge_feat_names):
         fname_dict[etype] = feat_info[1].split(",")
     return fname_dict
 
-def main(folder, node_feat_names, edge_feat_names, use_low_mem=False):
+def main(folder, node_feat_names, edge_feat_names, use_low_mem=False, target_dtype=None):
     """Convert features from distDGL tensor format to WholeGraph format"""
     os.environ["MASTER_ADDR"] = "127.0.0.1"
     os.environ["MASTER_PORT"] = "1234"
@@ -110,14 +110,14 @@ def main(folder, node_feat_names, edge_feat_names, use_low_mem=False):
     if node_feat_names:
         fname_dict = get_node_feat_info(node_feat_names)
         convert_feat_to_wholegraph(
-            fname_dict, "node_feat.dgl", metadata, folder, use_low_mem
+            fname_dict, "node_feat.dgl", metadata, folder, use_low_mem, target_dtype
         )
 
     # Process edge features
     if edge_feat_names:
         fname_dict = get_edge_feat_info(edge_feat_names)
         convert_feat_to_wholegraph(
-            fname_dict, "edge_feat.dgl", metadata, folder, use_low_mem
+            fname_dict, "edge_feat.dgl", metadata, folder, use_low_mem, target_dtype
         )
 
     # Save metatada
@@ -137,5 +137,15 @@ if __name__ == "__main__":
         "this argument for very large dataset. Please Note, this method is slower than "
         "regular conversion method.",
     )
+    parser.add_argument(
+        "--target-dtype",
+        type=str,
+        choices=["float16", "bfloat16"],
+        default=None,
+        help="Store floating-point features in this dtype to halve the disk and memory "
+        "footprint of WholeGraph features. Integer features are kept as they are.",
+    )
     args = parser.parse_args()
-    main(args.dataset_path, args.node_feat_names, args.edge_feat_names, args.low_mem)
+    target_dtype = getattr(torch, args.target_dtype) if args.target_dtype else None
+    main(args.dataset_path, args.node_feat_names, args.edge_feat_names, args.low_mem,
+         target_dtype)